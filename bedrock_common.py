@@ -0,0 +1,279 @@
+"""
+Shared AWS Bedrock helpers for the security issue prioritization tools.
+
+Builds prompts, calls Bedrock through the ConverseStream API with optional
+latency-optimized inference, prompt caching and forced tool use, and caches
+pairwise comparison results. Used by bubble_sort.py, elo_sort.py, score_sort.py
+and hybrid_sort.py.
+
+Written by: Daniel Grzelak (@dagrz on X, daniel.grzelak@plerion.com)  
+For more tools and security automation, visit: https://www.plerion.com
+"""
+
+import argparse
+import collections
+import functools
+import hashlib
+import string
+from typing import List, Dict, Any, Tuple
+
+import orjson
+from aiobotocore.config import AioConfig
+from diskcache import Cache
+
+# Translation table deleting C0 and C1 control characters
+_SANITIZE_TABLE = dict.fromkeys([*range(0x00, 0x20), *range(0x7F, 0xA0)])
+
+def sanitize_json_string(s: str) -> str:
+    """Remove control characters and sanitize JSON string."""
+    s = s.translate(_SANITIZE_TABLE)
+    return s if s.isprintable() else ''.join(c for c in s if c.isprintable() or c.isspace())
+
+# Output token limit of the Claude 3 models, the lowest among supported models
+MAX_BATCH_TOKENS = 4096
+
+# Tools the model is forced to call, so its verdicts and scores arrive as schema-shaped JSON
+COMPARISON_TOOL = {
+    "name": "rank_issues",
+    "description": "Record which of the two issues should be prioritized higher and why.",
+    "inputSchema": {"json": {
+        "type": "object",
+        "properties": {
+            "higher_priority_issue": {"type": "integer", "enum": [1, 2]},
+            "reasoning": {"type": "string"}
+        },
+        "required": ["higher_priority_issue", "reasoning"]
+    }}
+}
+BATCH_COMPARISON_TOOL = {
+    "name": "rank_issue_pairs",
+    "description": "Record, for each pair, which of its two issues should be prioritized higher and why.",
+    "inputSchema": {"json": {
+        "type": "object",
+        "properties": {
+            "verdicts": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "pair": {"type": "integer", "minimum": 1},
+                        "higher_priority_issue": {"type": "integer", "enum": [1, 2]},
+                        "reasoning": {"type": "string"}
+                    },
+                    "required": ["pair", "higher_priority_issue", "reasoning"]
+                }
+            }
+        },
+        "required": ["verdicts"]
+    }}
+}
+
+SCORING_TOOL = {
+    "name": "score_issue",
+    "description": "Record the priority score of the issue and why.",
+    "inputSchema": {"json": {
+        "type": "object",
+        "properties": {
+            "score": {"type": "integer", "minimum": 1, "maximum": 100},
+            "reasoning": {"type": "string"}
+        },
+        "required": ["score", "reasoning"]
+    }}
+}
+
+# Minimum HTTP connection pool size for the Bedrock client (botocore defaults to 10)
+MAX_POOL_CONNECTIONS = 64
+
+# Models that rejected latency-optimized inference, prompt caching or forced tool use, so later calls skip them
+_standard_latency_models = set()
+_uncached_prompt_models = set()
+_toolless_models = set()
+
+# Tokens reported in the metadata event of every ConverseStream response, summed over the run
+token_usage = collections.Counter()
+
+@functools.lru_cache(maxsize=None)
+def static_prefix(prompt_template: str) -> str:
+    """Return the literal text of a prompt template before its first placeholder."""
+    prefix = []
+    for literal, field_name, _, _ in string.Formatter().parse(prompt_template):
+        prefix.append(literal)
+        if field_name is not None:
+            break
+    return ''.join(prefix)
+
+async def converse(bedrock_client, model_id: str, prompt: str, latency_optimized: bool = True, max_tokens: int = 1000, prompt_prefix: str = '', tool: Dict[str, Any] = None) -> Any:
+    """Stream a single-turn prompt through the Bedrock ConverseStream API and return the response text.
+
+    `prompt_prefix`, the static start of `prompt`, is marked as a prompt cache checkpoint.
+    When `tool` is given the model is forced to call it and the parsed tool input is returned.
+    """
+    use_latency_optimized = latency_optimized and model_id not in _standard_latency_models
+    use_cache_point = bool(prompt_prefix) and prompt.startswith(prompt_prefix) and model_id not in _uncached_prompt_models
+    use_tool = tool is not None and model_id not in _toolless_models
+    while True:
+        content = [{"text": prompt}]
+        if use_cache_point:
+            content = [{"text": prompt_prefix}, {"cachePoint": {"type": "default"}}, {"text": prompt[len(prompt_prefix):]}]
+        request = {
+            "modelId": model_id,
+            "messages": [{"role": "user", "content": content}],
+            "inferenceConfig": {"maxTokens": max_tokens}
+        }
+        if use_latency_optimized:
+            request["performanceConfig"] = {"latency": "optimized"}
+        if use_tool:
+            request["toolConfig"] = {"tools": [{"toolSpec": tool}], "toolChoice": {"tool": {"name": tool["name"]}}}
+        try:
+            response = await bedrock_client.converse_stream(**request)
+            break
+        except bedrock_client.exceptions.ValidationException as e:
+            # Only drop the optional feature the error names, anything else (e.g. an oversized
+            # prompt) is a real error and must not disable features for later calls
+            message = str(e).lower()
+            if use_latency_optimized and ('latency' in message or 'performanceconfig' in message):
+                use_latency_optimized = False
+                _standard_latency_models.add(model_id)
+            elif use_cache_point and ('cachepoint' in message or 'caching' in message):
+                use_cache_point = False
+                _uncached_prompt_models.add(model_id)
+            elif use_tool and 'tool' in message:
+                use_tool = False
+                _toolless_models.add(model_id)
+            else:
+                raise
+    chunks = []
+    tool_input = []
+    # Read past messageStop to the final metadata event. Stopping early leaves the response
+    # body unread, so the connection is closed instead of going back to the pool.
+    async for event in response['stream']:
+        if 'contentBlockDelta' in event:
+            delta = event['contentBlockDelta']['delta']
+            if 'toolUse' in delta:
+                tool_input.append(delta['toolUse']['input'])
+            else:
+                chunks.append(delta.get('text', ''))
+        elif 'metadata' in event:
+            token_usage.update(event['metadata'].get('usage', {}))
+    if tool is None:
+        return ''.join(chunks)
+    if tool_input:
+        return orjson.loads(''.join(tool_input))
+    # Models without forced tool use answer in text, which the prompts ask to be JSON
+    return orjson.loads(sanitize_json_string(''.join(chunks)))
+
+def print_token_usage() -> None:
+    """Print the Bedrock tokens used by this run, including prompt cache reads and writes."""
+    if token_usage:
+        print(f"Bedrock tokens: {token_usage['inputTokens']} input, {token_usage['outputTokens']} output, "
+              f"{token_usage['cacheReadInputTokens']} read from and {token_usage['cacheWriteInputTokens']} written to the prompt cache")
+
+def bedrock_client_config(concurrency: int) -> AioConfig:
+    """Client config with a connection pool for `concurrency` in-flight calls and adaptive, throttling-aware retries."""
+    return AioConfig(max_pool_connections=max(MAX_POOL_CONNECTIONS, concurrency),
+                     retries={'max_attempts': 10, 'mode': 'adaptive'}, read_timeout=120, connect_timeout=10)
+
+def positive_int(value: str) -> int:
+    """argparse type for options that must be at least 1, such as concurrency and batch size."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return number
+
+def non_negative_int(value: str) -> int:
+    """argparse type for options where 0 is meaningful but negatives are not, such as --top-k-refine."""
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must be a non-negative integer, got {value}")
+    return number
+
+def load_prompt(file_path: str) -> str:
+    """Load prompt template from file."""
+    with open(file_path, 'r') as f:
+        return f.read()
+
+def cache_key(model_id: str, prompt_template: str, *issue_json: str) -> str:
+    """Hash the model, prompt template and serialized issues into a cache key."""
+    return hashlib.sha256(orjson.dumps([model_id, prompt_template, *issue_json])).hexdigest()
+
+def serialize_issue(issue: Dict[str, Any], issue_fields: List[str] = None) -> str:
+    """Serialize an issue for a prompt, keeping only `issue_fields` when given.
+
+    Keys are sorted so the same issue always serializes, and so hashes into a cache key,
+    identically regardless of the key order it was exported with.
+    """
+    if issue_fields is not None:
+        issue = {field: issue[field] for field in issue_fields if field in issue}
+    return orjson.dumps(issue, option=orjson.OPT_SORT_KEYS).decode()
+
+def create_comparison_prompt(issue1_json: str, issue2_json: str, prompt_template: str) -> str:
+    """Generate the LLM prompt for comparing two issues."""
+    return prompt_template.format(
+        issue1=issue1_json,
+        issue2=issue2_json
+    )
+
+def create_batch_comparison_prompt(pair_json: List[Tuple[str, str]], batch_prompt_template: str) -> str:
+    """Generate the LLM prompt for comparing several pairs of issues at once."""
+    return batch_prompt_template.format(pairs="\n\n".join(
+        f"Pair {k}:\n\nIssue 1:\n{issue1_json}\n\nIssue 2:\n{issue2_json}"
+        for k, (issue1_json, issue2_json) in enumerate(pair_json, 1)
+    ))
+
+async def compare_issues(issue1: Dict[str, Any], issue2: Dict[str, Any], issue1_json: str, issue2_json: str, bedrock_client, model_id: str, prompt_template: str, cache: Cache = None, latency_optimized: bool = True, max_tokens: int = 200, prompt_cache: bool = False) -> Tuple[bool, str]:
+    """Compare two issues via LLM and return whether issue1 is higher priority and the reasoning."""
+    key = cache_key(model_id, prompt_template, issue1_json, issue2_json)
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+    prompt = create_comparison_prompt(issue1_json, issue2_json, prompt_template)
+    try:
+        result = await converse(bedrock_client, model_id, prompt, latency_optimized, max_tokens,
+                                prompt_prefix=static_prefix(prompt_template) if prompt_cache else '', tool=COMPARISON_TOOL)
+        if not isinstance(result, dict) or 'reasoning' not in result or result.get('higher_priority_issue') not in [1, 2]:
+            raise ValueError("Invalid response format from model")
+        comparison = result['higher_priority_issue'] == 1, result['reasoning']
+        if cache is not None:
+            cache.set(key, comparison)
+        return comparison
+    except Exception as e:
+        print(f"Error during comparison: {e}")
+        sev_order = {'CRITICAL': 4, 'HIGH': 3, 'MEDIUM': 2, 'LOW': 1}
+        sev1 = sev_order.get(issue1.get('severityLevel', 'LOW'), 0)
+        sev2 = sev_order.get(issue2.get('severityLevel', 'LOW'), 0)
+        return sev1 >= sev2, f"Fallback comparison based on severity: {issue1.get('severityLevel')} vs {issue2.get('severityLevel')}"
+
+async def compare_issues_batch(pairs: List[Tuple[Dict[str, Any], Dict[str, Any]]], pair_json: List[Tuple[str, str]], bedrock_client, model_id: str, prompt_template: str, batch_prompt_template: str, cache: Cache = None, latency_optimized: bool = True, max_tokens: int = 200, prompt_cache: bool = False) -> List[Tuple[bool, str]]:
+    """Compare several pairs of issues in one LLM call, retrying missing or malformed verdicts individually."""
+    if len(pairs) == 1:
+        return [await compare_issues(*pairs[0], *pair_json[0], bedrock_client, model_id, prompt_template, cache, latency_optimized, max_tokens, prompt_cache)]
+    # Key verdicts like compare_issues does, so batched and single-pair runs share cache entries
+    keys = [cache_key(model_id, prompt_template, issue1_json, issue2_json) for issue1_json, issue2_json in pair_json]
+    results = [cache.get(key) if cache is not None else None for key in keys]
+    pending = [k for k, result in enumerate(results) if result is None]
+    if pending:
+        prompt = create_batch_comparison_prompt([pair_json[k] for k in pending], batch_prompt_template)
+        try:
+            result = await converse(bedrock_client, model_id, prompt, latency_optimized,
+                                    max_tokens=min(max_tokens * len(pending), MAX_BATCH_TOKENS),
+                                    prompt_prefix=static_prefix(batch_prompt_template) if prompt_cache else '',
+                                    tool=BATCH_COMPARISON_TOOL)
+            verdicts = result.get('verdicts') if isinstance(result, dict) else result
+            if not isinstance(verdicts, list):
+                raise ValueError("Invalid batch response format")
+            for verdict in verdicts:
+                if not isinstance(verdict, dict) or 'reasoning' not in verdict or verdict.get('higher_priority_issue') not in [1, 2]:
+                    continue
+                if not isinstance(verdict.get('pair'), int) or not 1 <= verdict['pair'] <= len(pending):
+                    continue
+                k = pending[verdict['pair'] - 1]
+                results[k] = verdict['higher_priority_issue'] == 1, verdict['reasoning']
+                if cache is not None:
+                    cache.set(keys[k], results[k])
+        except Exception as e:
+            print(f"Error during batch comparison: {e}")
+    for k, result in enumerate(results):
+        if result is None:
+            results[k] = await compare_issues(*pairs[k], *pair_json[k], bedrock_client, model_id, prompt_template, cache, latency_optimized, max_tokens, prompt_cache)
+    return results
@@ -21,6 +21,9 @@ Cons:
 - Expensive if each comparison requires an LLM call
 - Not suitable for very large input sets without optimization or batching
 
+For larger input sets, `--algorithm merge` drives the same comparisons with a merge
+sort instead, needing O(n log n) comparisons rather than O(n²).
+
 Features:
 - Supports multiple Anthropic Claude models via AWS Bedrock (Haiku, Sonnet, Opus)
 - Uses natural language prompts to drive prioritization logic
@@ -36,6 +39,16 @@ Options:
     --model          AWS Bedrock model ID (e.g., Claude Haiku, Sonnet, or Opus)
     --summary-only   Show prioritization summary from existing output file
     --prompt-file    Path to the prompt template file (default: bubble_prompt.txt)
+    --concurrency    Maximum number of concurrent Bedrock calls (default: 8)
+    --algorithm      Sorting algorithm: bubble (default) or merge (O(n log n) comparisons)
+    --cache-dir      Directory for caching Bedrock comparison results (default: .bedrock_cache)
+    --no-cache       Always call Bedrock instead of reusing cached comparison results
+    --no-latency-optimized  Use standard instead of latency-optimized Bedrock inference
+    --prompt-cache   Mark the prompt template's static text as a Bedrock prompt cache checkpoint (for long custom prompts)
+    --max-tokens     Maximum number of tokens generated per comparison (default: 200)
+    --issue-fields   Comma-separated allowlist of issue fields to include in prompts (default: all fields)
+    --batch-size     Number of comparisons to pack into each Bedrock call, bubble sort only (default: 1)
+    --batch-prompt-file  Path to the batched comparison prompt template (default: bubble_batch_prompt.txt)
 
 Output:
     - `prioritized-issues.json`: Sorted issues with comparison metadata and reasoning
@@ -48,14 +61,18 @@ For more tools and security automation, visit: https://www.plerion.com
 
 
 import argparse
-import json
-import boto3
+import orjson
+import aioboto3
+import asyncio
+from diskcache import Cache
 from typing import List, Dict, Any, Tuple
 import base64
 from tqdm import tqdm
-import re
+import math
 import time
 
+from bedrock_common import bedrock_client_config, compare_issues, compare_issues_batch, load_prompt, positive_int, print_token_usage, serialize_issue
+
 def parse_arguments() -> argparse.Namespace:
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(
@@ -94,94 +111,145 @@ def parse_arguments() -> argparse.Namespace:
         default="bubble_prompt.txt",
         help="Path to the prompt template file (default: bubble_prompt.txt)"
     )
+    parser.add_argument(
+        "--concurrency",
+        "--max-workers",
+        type=positive_int,
+        default=8,
+        help="Maximum number of concurrent Bedrock calls (default: 8)"
+    )
+    parser.add_argument(
+        "--algorithm",
+        type=str,
+        choices=["bubble", "merge"],
+        default="bubble",
+        help="Sorting algorithm to drive the comparisons. Options:\n"
+             "- bubble: n(n-1)/2 comparisons, concurrent within each phase\n"
+             "- merge: at most n*ceil(log2(n)) comparisons, concurrent across independent merges\n"
+             "Default: bubble"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=".bedrock_cache",
+        help="Directory for caching Bedrock comparison results between runs (default: .bedrock_cache)"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always call Bedrock instead of reusing cached comparison results"
+    )
+    parser.add_argument(
+        "--latency-optimized",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Request Bedrock latency-optimized inference, falling back to standard inference "
+             "for models that don't support it (default: enabled)"
+    )
+    parser.add_argument(
+        "--prompt-cache",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Mark the text before the prompt template's first placeholder as a Bedrock prompt cache checkpoint. "
+             "Only pays off for custom templates whose static text reaches the model's minimum cacheable length "
+             "(default: disabled)"
+    )
+    parser.add_argument(
+        "--max-tokens",
+        type=positive_int,
+        default=200,
+        help="Maximum number of tokens the model may generate per comparison (default: 200)"
+    )
+    parser.add_argument(
+        "--issue-fields",
+        type=str,
+        default=None,
+        help="Comma-separated allowlist of issue fields to include in prompts, e.g. id,type,severityLevel,title,message "
+             "(default: all fields)"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=positive_int,
+        default=1,
+        help="Number of comparisons to pack into each Bedrock call, bubble sort only (default: 1 = no batching)"
+    )
+    parser.add_argument(
+        "--batch-prompt-file",
+        type=str,
+        default="bubble_batch_prompt.txt",
+        help="Path to the prompt template file for batched comparisons (default: bubble_batch_prompt.txt)"
+    )
     return parser.parse_args()
 
 def load_issues(file_path: str) -> List[Dict[str, Any]]:
     """Load security issues from a JSON file."""
-    with open(file_path, 'r') as f:
-        data = json.load(f)
+    with open(file_path, 'rb') as f:
+        data = orjson.loads(f.read())
         return data.get('issues', [])
 
-def save_issues(issues: List[Dict[str, Any]], file_path: str) -> None:
-    """Save prioritized issues to a JSON file."""
-    with open(file_path, 'w') as f:
-        json.dump({'issues': issues}, f, indent=2)
+def save_issues(issues: List[Dict[str, Any]], file_path: str, comparisons: List[Dict[str, Any]] = None) -> None:
+    """Save prioritized issues, and the comparisons they reference when given, to a JSON file."""
+    data = {'issues': issues}
+    if comparisons is not None:
+        data['comparisons'] = comparisons
+    with open(file_path, 'wb') as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
 
-def sanitize_json_string(s: str) -> str:
-    """Remove control characters and sanitize JSON string."""
-    # Remove control characters
-    s = re.sub(r'[\x00-\x1F\x7F-\x9F]', '', s)
-    # Remove any non-printable characters
-    s = ''.join(char for char in s if char.isprintable() or char.isspace())
-    return s
-
-def load_prompt(file_path: str) -> str:
-    """Load prompt template from file."""
-    with open(file_path, 'r') as f:
-        return f.read()
+def record_comparison(comparisons: List[Dict[str, Any]], issue1: Dict[str, Any], issue2: Dict[str, Any], issue1_id: str, issue2_id: str, is_higher: bool, reasoning: str) -> None:
+    """Record a comparison once in `comparisons` and reference it from both compared issues."""
+    comparisons.append({
+        'a_id': issue1_id,
+        'b_id': issue2_id,
+        'winner': 1 if is_higher else 2,
+        'reasoning': reasoning
+    })
+    
+    for issue in (issue1, issue2):
+        issue.setdefault('comparison_ids', []).append(len(comparisons) - 1)
 
-def create_comparison_prompt(issue1: Dict[str, Any], issue2: Dict[str, Any], prompt_template: str) -> str:
-    """Create a prompt for comparing two security issues."""
-    return prompt_template.format(
-        issue1=json.dumps(issue1, indent=2),
-        issue2=json.dumps(issue2, indent=2)
-    )
+async def bubble_sort_issues(issues: List[Dict[str, Any]], bedrock_client, model_id: str, prompt_template: str, concurrency: int = 8, cache: Cache = None, latency_optimized: bool = True, batch_size: int = 1, batch_prompt_template: str = None, max_tokens: int = 200, issue_fields: List[str] = None, prompt_cache: bool = False) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Sort security issues using bubble sort based on AI pairwise comparisons.
 
-def compare_issues(issue1: Dict[str, Any], issue2: Dict[str, Any], bedrock_client, model_id: str, prompt_template: str) -> Tuple[bool, str]:
-    """Compare two security issues using AWS Bedrock."""
-    prompt = create_comparison_prompt(issue1, issue2, prompt_template)
+    Uses odd-even transposition sort, the parallel form of bubble sort. Each phase
+    compares disjoint adjacent pairs, so the comparisons within a phase are independent
+    and run concurrently, up to `concurrency` Bedrock calls at a time and `batch_size`
+    pairs per call. Swaps are applied in index order once a phase completes.
     
-    try:
-        response = bedrock_client.invoke_model(
-            modelId=model_id,
-            body=json.dumps({
-                "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": 1000,
-                "messages": [{
-                    "role": "user",
-                    "content": prompt
-                }]
-            })
-        )
-        
-        response_body = json.loads(response['body'].read())
-        response_text = response_body['content'][0]['text']
-        
-        # Sanitize the response text
-        sanitized_text = sanitize_json_string(response_text)
-        
-        try:
-            result = json.loads(sanitized_text)
-        except json.JSONDecodeError as e:
-            print(f"Error parsing JSON response: {str(e)}")
-            print(f"Raw response: {response_text}")
-            print(f"Sanitized response: {sanitized_text}")
-            raise
-        
-        if not isinstance(result, dict) or 'higher_priority_issue' not in result or 'reasoning' not in result:
-            raise ValueError("Invalid response format from model")
-            
-        if result['higher_priority_issue'] not in [1, 2]:
-            raise ValueError(f"Invalid higher_priority_issue value: {result['higher_priority_issue']}")
-        
-        return result['higher_priority_issue'] == 1, result['reasoning']
-        
-    except Exception as e:
-        print(f"Error comparing issues: {str(e)}")
-        # Fallback to basic severity comparison if Bedrock fails
-        severity_order = {'CRITICAL': 4, 'HIGH': 3, 'MEDIUM': 2, 'LOW': 1}
-        sev1 = severity_order.get(issue1.get('severityLevel', 'LOW'), 0)
-        sev2 = severity_order.get(issue2.get('severityLevel', 'LOW'), 0)
-        return sev1 >= sev2, f"Fallback comparison based on severity levels: {issue1.get('severityLevel')} vs {issue2.get('severityLevel')}"
-
-def bubble_sort_issues(issues: List[Dict[str, Any]], bedrock_client, model_id: str, prompt_template: str) -> List[Dict[str, Any]]:
-    """Sort security issues using bubble sort based on AI pairwise comparisons."""
+    Stops early once an even and an odd phase in a row make no swaps, since every
+    adjacent pair has then been compared and found in order.
+    
+    Returns the sorted issues and the comparisons made, which each issue references
+    by index through its `comparison_ids`.
+    """
     n = len(issues)
-    total_comparisons = (n * (n - 1)) // 2  # Total number of comparisons in bubble sort
+    # Serialize each issue once up front rather than once per comparison
+    issue_json = [serialize_issue(issue, issue_fields) for issue in issues]
+    # Even phases compare (0, 1), (2, 3), ...; odd phases compare (1, 2), (3, 4), ...
+    phases = [range(phase % 2, n - 1, 2) for phase in range(n)]
+    total_comparisons = sum(len(phase) for phase in phases)  # Same as bubble sort: n * (n - 1) / 2
+    semaphore = asyncio.Semaphore(concurrency)
+    comparisons: List[Dict[str, Any]] = []
+    
+    async def compare_batch(batch: range) -> List[Tuple[bool, str]]:
+        async with semaphore:
+            return await compare_issues_batch(
+                [(issues[j], issues[j + 1]) for j in batch],
+                [(issue_json[j], issue_json[j + 1]) for j in batch],
+                bedrock_client, model_id, prompt_template, batch_prompt_template, cache, latency_optimized, max_tokens, prompt_cache
+            )
     
     with tqdm(total=total_comparisons, desc="Comparing issues") as pbar:
-        for i in range(n):
-            for j in range(0, n - i - 1):
+        # Number of consecutive phases without a swap
+        phases_without_swaps = 0
+        
+        for phase in phases:
+            # Issue all comparisons for this phase before applying any swaps
+            batches = [phase[k:k + batch_size] for k in range(0, len(phase), batch_size)]
+            batch_results = await asyncio.gather(*(compare_batch(batch) for batch in batches))
+            results = (result for batch in batch_results for result in batch)
+            
+            swapped = False
+            for j, (is_higher, reasoning) in zip(phase, results):
                 # Get issue identifiers for progress display
                 issue1_id = issues[j].get('id', issues[j].get('vulnerabilityId', f'Issue {j}'))
                 issue2_id = issues[j + 1].get('id', issues[j + 1].get('vulnerabilityId', f'Issue {j + 1}'))
@@ -189,36 +257,107 @@ def bubble_sort_issues(issues: List[Dict[str, Any]], bedrock_client, model_id: s
                 # Update progress description
                 pbar.set_description(f"Comparing {issue1_id} vs {issue2_id}")
                 
-                is_higher, reasoning = compare_issues(issues[j], issues[j + 1], bedrock_client, model_id, prompt_template)
-                
-                # Store the comparison reasoning
-                if 'comparison_reasoning' not in issues[j]:
-                    issues[j]['comparison_reasoning'] = []
-                if 'comparison_reasoning' not in issues[j + 1]:
-                    issues[j + 1]['comparison_reasoning'] = []
-                
-                # Add the reasoning to both issues
-                comparison = {
-                    'compared_with': issues[j + 1].get('id', issues[j + 1].get('vulnerabilityId', str(j + 1))),
-                    'reasoning': reasoning,
-                    'was_higher_priority': is_higher
-                }
-                issues[j]['comparison_reasoning'].append(comparison)
-                
-                comparison = {
-                    'compared_with': issues[j].get('id', issues[j].get('vulnerabilityId', str(j))),
-                    'reasoning': reasoning,
-                    'was_higher_priority': not is_higher
-                }
-                issues[j + 1]['comparison_reasoning'].append(comparison)
+                # Store the comparison reasoning once, referenced by both issues
+                record_comparison(
+                    comparisons, issues[j], issues[j + 1],
+                    issues[j].get('id', issues[j].get('vulnerabilityId', str(j))),
+                    issues[j + 1].get('id', issues[j + 1].get('vulnerabilityId', str(j + 1))),
+                    is_higher, reasoning
+                )
                 
                 # Swap if needed
                 if not is_higher:
                     issues[j], issues[j + 1] = issues[j + 1], issues[j]
+                    issue_json[j], issue_json[j + 1] = issue_json[j + 1], issue_json[j]
+                    swapped = True
                 
                 pbar.update(1)
+            
+            phases_without_swaps = 0 if swapped else phases_without_swaps + 1
+            if phases_without_swaps == 2:
+                break
+        
+        # Sorting usually finishes early, so settle the bar on the actual count
+        pbar.total = pbar.n
+        pbar.refresh()
     
-    return issues
+    return issues, comparisons
+
+async def merge_sort_issues(issues: List[Dict[str, Any]], bedrock_client, model_id: str, prompt_template: str, concurrency: int = 8, cache: Cache = None, latency_optimized: bool = True, max_tokens: int = 200, issue_fields: List[str] = None, prompt_cache: bool = False) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Sort security issues using merge sort based on AI pairwise comparisons.
+
+    Needs at most n*ceil(log2(n)) comparisons instead of bubble sort's n(n-1)/2.
+    Comparisons within one merge depend on each other, but the two halves being
+    merged are sorted concurrently, up to `concurrency` Bedrock calls at a time.
+    
+    Returns the sorted issues and the comparisons made, which each issue references
+    by index through its `comparison_ids`.
+    """
+    n = len(issues)
+    depth = math.ceil(math.log2(n)) if n > 1 else 0
+    max_comparisons = n * depth - 2 ** depth + 1 if n > 1 else 0  # Worst case for top-down merge sort
+    
+    # Original positions, used as identifiers for issues without an id
+    positions = {id(issue): str(k) for k, issue in enumerate(issues)}
+    # Serialize each issue once up front rather than once per comparison
+    issue_json = {id(issue): serialize_issue(issue, issue_fields) for issue in issues}
+    # Results of comparisons already made, keyed by the identity of the compared issues
+    compared: Dict[Tuple[int, int], bool] = {}
+    comparisons: List[Dict[str, Any]] = []
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    with tqdm(total=max_comparisons, desc="Comparing issues") as pbar:
+        async def is_higher_priority(issue1: Dict[str, Any], issue2: Dict[str, Any]) -> bool:
+            key = (id(issue1), id(issue2))
+            if key in compared:
+                return compared[key]
+            if key[::-1] in compared:
+                return not compared[key[::-1]]
+            
+            issue1_id = issue1.get('id', issue1.get('vulnerabilityId', positions[id(issue1)]))
+            issue2_id = issue2.get('id', issue2.get('vulnerabilityId', positions[id(issue2)]))
+            pbar.set_description(f"Comparing {issue1_id} vs {issue2_id}")
+            
+            async with semaphore:
+                is_higher, reasoning = await compare_issues(
+                    issue1, issue2, issue_json[id(issue1)], issue_json[id(issue2)],
+                    bedrock_client, model_id, prompt_template, cache, latency_optimized, max_tokens, prompt_cache
+                )
+            record_comparison(comparisons, issue1, issue2, issue1_id, issue2_id, is_higher, reasoning)
+            compared[key] = is_higher
+            
+            pbar.update(1)
+            return is_higher
+        
+        async def merge_sort(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+            if len(items) <= 1:
+                return items
+            
+            # The two halves are independent, so sort them concurrently
+            mid = len(items) // 2
+            left, right = await asyncio.gather(merge_sort(items[:mid]), merge_sort(items[mid:]))
+            
+            # Emit whichever head of the two sorted halves is higher priority
+            merged = []
+            i = j = 0
+            while i < len(left) and j < len(right):
+                if await is_higher_priority(left[i], right[j]):
+                    merged.append(left[i])
+                    i += 1
+                else:
+                    merged.append(right[j])
+                    j += 1
+            merged.extend(left[i:])
+            merged.extend(right[j:])
+            return merged
+        
+        sorted_issues = await merge_sort(issues)
+        
+        # Merges usually finish early, so settle the bar on the actual count
+        pbar.total = pbar.n
+        pbar.refresh()
+    
+    return sorted_issues, comparisons
 
 def print_prioritization_summary(issues: List[Dict[str, Any]], runtime: float) -> None:
     """Print a summary of the prioritized issues."""
@@ -251,15 +390,15 @@ def print_prioritization_summary(issues: List[Dict[str, Any]], runtime: float) -
     print(f"Total issues prioritized: {len(issues)}")
     print(f"Total runtime: {runtime:.2f} seconds")
 
-def main():
+async def main_async():
     args = parse_arguments()
     start_time = time.time()
     
     if args.summary_only:
         try:
             print(f"Loading prioritized issues from {args.output}...")
-            with open(args.output, 'r') as f:
-                data = json.load(f)
+            with open(args.output, 'rb') as f:
+                data = orjson.loads(f.read())
                 issues = data.get('issues', [])
             print(f"Loaded {len(issues)} issues")
             print_prioritization_summary(issues, time.time() - start_time)
@@ -267,13 +406,10 @@ def main():
         except FileNotFoundError:
             print(f"Error: Output file {args.output} not found. Run prioritization first.")
             return
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             print(f"Error: {args.output} is not a valid JSON file.")
             return
     
-    # Initialize AWS Bedrock client
-    bedrock_client = boto3.client('bedrock-runtime')
-    
     # Load issues
     issues = load_issues(args.issues)
     print(f"Loaded {len(issues)} issues")
@@ -282,18 +418,45 @@ def main():
     prompt_template = load_prompt(args.prompt_file)
     print(f"Loaded prompt template from {args.prompt_file}")
     
-    # Sort issues
-    print(f"Starting prioritization using {args.model}...")
-    prioritized_issues = bubble_sort_issues(issues, bedrock_client, args.model, prompt_template)
+    batch_prompt_template = None
+    if args.batch_size > 1:
+        batch_prompt_template = load_prompt(args.batch_prompt_file)
+        print(f"Loaded batch prompt template from {args.batch_prompt_file}")
+    
+    # Open the comparison cache
+    cache = None if args.no_cache else Cache(args.cache_dir)
+    
+    issue_fields = args.issue_fields.split(',') if args.issue_fields else None
+    
+    # Initialize AWS Bedrock client and sort issues
+    print(f"Starting prioritization using {args.model} with {args.algorithm} sort...")
+    async with aioboto3.Session().client('bedrock-runtime', config=bedrock_client_config(args.concurrency)) as bedrock_client:
+        if args.algorithm == "merge":
+            prioritized_issues, comparisons = await merge_sort_issues(
+                issues, bedrock_client, args.model, prompt_template, args.concurrency, cache, args.latency_optimized,
+                args.max_tokens, issue_fields, args.prompt_cache
+            )
+        else:
+            prioritized_issues, comparisons = await bubble_sort_issues(
+                issues, bedrock_client, args.model, prompt_template, args.concurrency, cache,
+                args.latency_optimized, args.batch_size, batch_prompt_template, args.max_tokens, issue_fields,
+                args.prompt_cache
+            )
+    if cache is not None:
+        cache.close()
     
     # Save results
     print(f"Saving prioritized issues to {args.output}...")
-    save_issues(prioritized_issues, args.output)
+    save_issues(prioritized_issues, args.output, comparisons)
     print(f"Prioritized issues saved to {args.output}")
     
     # Print summary
     runtime = time.time() - start_time
     print_prioritization_summary(prioritized_issues, runtime)
+    print_token_usage()
+
+def main():
+    asyncio.run(main_async())
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -12,7 +12,8 @@ rationale for each comparison.
 
 Elo scoring is used to determine relative ranking through repeated pairwise 
 comparisons. It has the advantage of being more scalable and statistically grounded
-compared to bubble sort.
+compared to bubble sort. Comparisons are scheduled in Swiss-style rounds that pair
+issues with similar ratings, so O(n log n) comparisons are enough for a ranking.
 
 Pros of Elo scoring in this context:
 - More efficient than bubble sort (fewer comparisons for large n)
@@ -39,8 +40,19 @@ Options:
     --output         Output file for sorted and annotated issues (default: prioritized-issues.json)
     --model          AWS Bedrock model ID (e.g., Claude Haiku, Sonnet, or Opus)
     --summary-only   Show prioritization summary from existing output file
-    --max-comparisons Maximum number of comparisons as a multiple of total pairs (default: 1.0 = all pairs)
+    --max-comparisons Upper bound on comparisons as a fraction of all pairs (default: 1.0 = no cap beyond the rounds)
+    --rounds         Number of Swiss-style comparison rounds (default: ceil(log2(n)))
+    --convergence    Stop once no Elo rating changes by at least this much in a round (default: 0 = run all rounds)
     --prompt-file    Path to the prompt template file (default: elo_prompt.txt)
+    --concurrency    Maximum number of concurrent Bedrock calls (default: 8)
+    --cache-dir      Directory for caching Bedrock comparison results (default: .bedrock_cache)
+    --no-cache       Always call Bedrock instead of reusing cached comparison results
+    --no-latency-optimized  Use standard instead of latency-optimized Bedrock inference
+    --prompt-cache   Mark the prompt template's static text as a Bedrock prompt cache checkpoint (for long custom prompts)
+    --max-tokens     Maximum number of tokens generated per comparison (default: 200)
+    --issue-fields   Comma-separated allowlist of issue fields to include in prompts (default: all fields)
+    --batch-size     Number of comparisons to pack into each Bedrock call (default: 1 = no batching)
+    --batch-prompt-file  Path to the batched comparison prompt template (default: elo_batch_prompt.txt)
 
 Output:
     - `prioritized-issues.json`: Sorted issues with comparison metadata and reasoning
@@ -51,13 +63,18 @@ For more tools and security automation, visit: https://www.plerion.com
 """
 
 import argparse
-import json
-import boto3
+import orjson
+import aioboto3
+import asyncio
+from diskcache import Cache
 from typing import List, Dict, Any, Tuple
-import re
+import math
+import numpy as np
 from tqdm import tqdm
 import time
 
+from bedrock_common import bedrock_client_config, compare_issues_batch, load_prompt, positive_int, print_token_usage, serialize_issue
+
 def parse_arguments() -> argparse.Namespace:
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(
@@ -68,113 +85,136 @@ def parse_arguments() -> argparse.Namespace:
     parser.add_argument("--model", type=str, default="anthropic.claude-3-haiku-20240307-v1:0")
     parser.add_argument("--summary-only", action="store_true")
     parser.add_argument("--max-comparisons", type=float, default=1.0,
-                      help="Maximum number of comparisons as a multiple of total pairs (default: 1.0 = all pairs)")
+                      help="Upper bound on the comparisons made across all rounds, as a fraction of all n(n-1)/2 pairs (default: 1.0 = no cap beyond the rounds)")
+    parser.add_argument("--rounds", type=int, default=None,
+                      help="Number of Swiss-style comparison rounds (default: ceil(log2(n)))")
+    parser.add_argument("--convergence", type=float, default=0.0,
+                      help="Stop once no Elo rating changes by at least this much in a round (default: 0 = run all rounds)")
     parser.add_argument("--prompt-file", type=str, default="elo_prompt.txt",
                       help="Path to the prompt template file (default: elo_prompt.txt)")
+    parser.add_argument("--concurrency", "--max-workers", type=positive_int, default=8,
+                      help="Maximum number of concurrent Bedrock calls (default: 8)")
+    parser.add_argument("--cache-dir", type=str, default=".bedrock_cache",
+                      help="Directory for caching Bedrock comparison results between runs (default: .bedrock_cache)")
+    parser.add_argument("--no-cache", action="store_true",
+                      help="Always call Bedrock instead of reusing cached comparison results")
+    parser.add_argument("--latency-optimized", action=argparse.BooleanOptionalAction, default=True,
+                      help="Request Bedrock latency-optimized inference, falling back to standard inference for unsupported models (default: enabled)")
+    parser.add_argument("--prompt-cache", action=argparse.BooleanOptionalAction, default=False,
+                      help="Mark the text before the prompt template's first placeholder as a Bedrock prompt cache checkpoint. Only pays off for custom templates whose static text reaches the model's minimum cacheable length (default: disabled)")
+    parser.add_argument("--max-tokens", type=positive_int, default=200,
+                      help="Maximum number of tokens the model may generate per comparison (default: 200)")
+    parser.add_argument("--issue-fields", type=str, default=None,
+                      help="Comma-separated allowlist of issue fields to include in prompts, e.g. id,type,severityLevel,title,message (default: all fields)")
+    parser.add_argument("--batch-size", type=positive_int, default=1,
+                      help="Number of comparisons to pack into each Bedrock call (default: 1 = no batching)")
+    parser.add_argument("--batch-prompt-file", type=str, default="elo_batch_prompt.txt",
+                      help="Path to the prompt template file for batched comparisons (default: elo_batch_prompt.txt)")
     return parser.parse_args()
 
 def load_issues(file_path: str) -> List[Dict[str, Any]]:
     """Load security issues from a JSON file."""
-    with open(file_path, 'r') as f:
-        return json.load(f).get('issues', [])
-
-def save_issues(issues: List[Dict[str, Any]], file_path: str) -> None:
-    """Save prioritized issues to a JSON file."""
-    with open(file_path, 'w') as f:
-        json.dump({'issues': issues}, f, indent=2)
-
-def sanitize_json_string(s: str) -> str:
-    """Remove control characters and sanitize JSON string."""
-    s = re.sub(r'[\x00-\x1F\x7F-\x9F]', '', s)
-    return ''.join(c for c in s if c.isprintable() or c.isspace())
-
-def load_prompt(file_path: str) -> str:
-    """Load prompt template from file."""
-    with open(file_path, 'r') as f:
-        return f.read()
-
-def create_comparison_prompt(issue1: Dict[str, Any], issue2: Dict[str, Any], prompt_template: str) -> str:
-    """Generate the LLM prompt for comparing two issues."""
-    return prompt_template.format(
-        issue1=json.dumps(issue1, indent=2),
-        issue2=json.dumps(issue2, indent=2)
-    )
-
-def compare_issues(issue1: Dict[str, Any], issue2: Dict[str, Any], bedrock_client, model_id: str, prompt_template: str) -> Tuple[bool, str]:
-    """Compare two issues via LLM and return whether issue1 is higher priority and the reasoning."""
-    prompt = create_comparison_prompt(issue1, issue2, prompt_template)
-    try:
-        response = bedrock_client.invoke_model(
-            modelId=model_id,
-            body=json.dumps({
-                "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": 1000,
-                "messages": [{"role": "user", "content": prompt}]
-            })
-        )
-        response_text = json.loads(response['body'].read())['content'][0]['text']
-        result = json.loads(sanitize_json_string(response_text))
-        if result['higher_priority_issue'] not in [1, 2]:
-            raise ValueError("Invalid `higher_priority_issue` value")
-        return result['higher_priority_issue'] == 1, result['reasoning']
-    except Exception as e:
-        print(f"Error during comparison: {e}")
-        sev_order = {'CRITICAL': 4, 'HIGH': 3, 'MEDIUM': 2, 'LOW': 1}
-        sev1 = sev_order.get(issue1.get('severityLevel', 'LOW'), 0)
-        sev2 = sev_order.get(issue2.get('severityLevel', 'LOW'), 0)
-        return sev1 >= sev2, f"Fallback comparison based on severity: {issue1.get('severityLevel')} vs {issue2.get('severityLevel')}"
-
-def elo_rank_issues(issues: List[Dict[str, Any]], bedrock_client, model_id: str, prompt_template: str, max_comparisons_multiplier: float = 1.0) -> List[Dict[str, Any]]:
-    """Rank issues using Elo scoring and pairwise LLM comparisons."""
+    with open(file_path, 'rb') as f:
+        return orjson.loads(f.read()).get('issues', [])
+
+def save_issues(issues: List[Dict[str, Any]], file_path: str, comparisons: List[Dict[str, Any]] = None) -> None:
+    """Save prioritized issues, and the comparisons they reference when given, to a JSON file."""
+    data = {'issues': issues}
+    if comparisons is not None:
+        data['comparisons'] = comparisons
+    with open(file_path, 'wb') as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+
+def swiss_pairings(ratings: np.ndarray, played: set, first_round: bool = False) -> List[Tuple[int, int]]:
+    """Pair each issue with the closest-rated issue it hasn't been compared with yet."""
+    order = np.argsort(-ratings, kind='stable').tolist()
+    if first_round:
+        # Ratings are all equal, so pair the top half against the bottom half for broader coverage
+        half = len(order) // 2
+        return [(order[k], order[k + half]) for k in range(half)]
+    pairs = []
+    while len(order) > 1:
+        i = order.pop(0)
+        j = next((j for j in order if frozenset((i, j)) not in played), None)
+        if j is not None:  # Otherwise i has been compared with everyone left and sits this round out
+            order.remove(j)
+            pairs.append((i, j))
+    return pairs
+
+async def elo_rank_issues(issues: List[Dict[str, Any]], bedrock_client, model_id: str, prompt_template: str, max_comparisons_multiplier: float = 1.0, concurrency: int = 8, cache: Cache = None, latency_optimized: bool = True, batch_size: int = 1, batch_prompt_template: str = None, rounds: int = None, convergence: float = 0.0, max_tokens: int = 200, issue_fields: List[str] = None, prompt_cache: bool = False) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Rank issues using Elo scoring and pairwise LLM comparisons over Swiss-style rounds.
+
+    Each round pairs issues with similar ratings, so O(n log n) comparisons are enough to
+    converge on a ranking. Stops early once no rating moves by `convergence` or more in a round.
+    Returns the ranked issues and the comparisons made, which issues reference through `comparison_ids`.
+    """
     K = 32
+    # Serialize each issue once, before it is annotated, rather than once per comparison
+    issue_json = [serialize_issue(issue, issue_fields) for issue in issues]
     for issue in issues:
-        issue['elo'] = 1200
-        issue['comparison_reasoning'] = []
+        issue['comparison_ids'] = []
+    ratings = np.full(len(issues), 1200.0)
+    comparisons = []
 
     # Calculate total possible pairs and max comparisons
     total_pairs = len(issues) * (len(issues) - 1) // 2
     max_comparisons = int(total_pairs * max_comparisons_multiplier)
-    
-    # Generate all possible pairs
-    pairs = [(i, j) for i in range(len(issues)) for j in range(i + 1, len(issues))]
-    
-    # If we're limiting comparisons, randomly sample the pairs
-    if max_comparisons < total_pairs:
-        import random
-        random.seed(42)  # For reproducibility
-        pairs = random.sample(pairs, max_comparisons)
-
-    with tqdm(total=len(pairs), desc="Ranking with Elo") as pbar:
-        for i, j in pairs:
-            issue1, issue2 = issues[i], issues[j]
-            id1 = issue1.get('id', f'Issue {i}')
-            id2 = issue2.get('id', f'Issue {j}')
-            pbar.set_description(f"Comparing {id1} vs {id2}")
-
-            r1, r2 = issue1['elo'], issue2['elo']
-            expected1 = 1 / (1 + 10 ** ((r2 - r1) / 400))
-            expected2 = 1 - expected1
-
-            is_higher, reasoning = compare_issues(issue1, issue2, bedrock_client, model_id, prompt_template)
-            score1, score2 = (1, 0) if is_higher else (0, 1)
-
-            issue1['elo'] += K * (score1 - expected1)
-            issue2['elo'] += K * (score2 - expected2)
-
-            issue1['comparison_reasoning'].append({
-                'compared_with': id2,
-                'reasoning': reasoning,
-                'was_higher_priority': is_higher
-            })
-            issue2['comparison_reasoning'].append({
-                'compared_with': id1,
-                'reasoning': reasoning,
-                'was_higher_priority': not is_higher
-            })
-
-            pbar.update(1)
-
-    return sorted(issues, key=lambda x: x['elo'], reverse=True)
+    if rounds is None:
+        rounds = math.ceil(math.log2(len(issues))) if len(issues) > 1 else 0
+
+    played = set()
+    semaphore = asyncio.Semaphore(concurrency)
+    with tqdm(total=min(rounds * (len(issues) // 2), max_comparisons), desc="Ranking with Elo") as pbar:
+        async def compare_batch(batch: List[Tuple[int, int]]) -> List[Tuple[bool, str]]:
+            async with semaphore:
+                batch_results = await compare_issues_batch([(issues[i], issues[j]) for i, j in batch],
+                                                           [(issue_json[i], issue_json[j]) for i, j in batch], bedrock_client,
+                                                           model_id, prompt_template, batch_prompt_template, cache, latency_optimized, max_tokens,
+                                                           prompt_cache)
+            pbar.update(len(batch_results))
+            return batch_results
+
+        for round_number in range(rounds):
+            pairs = swiss_pairings(ratings, played, first_round=round_number == 0)
+            pairs = pairs[:max_comparisons - len(played)]
+            if not pairs:
+                break
+            played.update(frozenset(pair) for pair in pairs)
+            pbar.set_description(f"Ranking with Elo (round {round_number + 1}/{rounds})")
+
+            # Comparisons within a round are independent, so run them concurrently, up to
+            # batch_size pairs per LLM call, and apply the rating updates afterwards all at once
+            batches = [pairs[k:k + batch_size] for k in range(0, len(pairs), batch_size)]
+            batch_results = await asyncio.gather(*(compare_batch(batch) for batch in batches))
+            results = [result for batch in batch_results for result in batch]
+
+            firsts, seconds = np.array(pairs).T
+            scores = np.array([is_higher for is_higher, _ in results], dtype=float)
+            expected = 1 / (1 + 10 ** ((ratings[seconds] - ratings[firsts]) / 400))
+            delta = K * (scores - expected)
+            np.add.at(ratings, firsts, delta)
+            np.add.at(ratings, seconds, -delta)
+            max_delta = np.abs(delta).max()
+
+            for (i, j), (is_higher, reasoning) in zip(pairs, results):
+                issue1, issue2 = issues[i], issues[j]
+                id1 = issue1.get('id', f'Issue {i}')
+                id2 = issue2.get('id', f'Issue {j}')
+
+                # Store the reasoning once, referenced from both issues
+                issue1['comparison_ids'].append(len(comparisons))
+                issue2['comparison_ids'].append(len(comparisons))
+                comparisons.append({'a_id': id1, 'b_id': id2, 'winner': 1 if is_higher else 2, 'reasoning': reasoning})
+
+            if max_delta < convergence:
+                break
+
+        pbar.total = pbar.n
+        pbar.refresh()
+
+    for issue, rating in zip(issues, ratings.tolist()):
+        issue['elo'] = rating
+    return [issues[k] for k in np.argsort(-ratings, kind='stable')], comparisons
 
 def print_prioritization_summary(issues: List[Dict[str, Any]], runtime: float) -> None:
     """Print the ranked summary of prioritized issues."""
@@ -192,36 +232,52 @@ def print_prioritization_summary(issues: List[Dict[str, Any]], runtime: float) -
     print(f"Total issues prioritized: {len(issues)}")
     print(f"Total runtime: {runtime:.2f} seconds")
 
-def main():
+async def main_async():
     args = parse_arguments()
     start_time = time.time()
 
     if args.summary_only:
         try:
-            with open(args.output, 'r') as f:
-                issues = json.load(f).get('issues', [])
+            with open(args.output, 'rb') as f:
+                issues = orjson.loads(f.read()).get('issues', [])
             print_prioritization_summary(issues, time.time() - start_time)
             return
         except Exception as e:
             print(f"Error reading summary: {e}")
             return
 
-    bedrock_client = boto3.client('bedrock-runtime')
-
     issues = load_issues(args.issues)
     print(f"Loaded {len(issues)} issues")
 
     prompt_template = load_prompt(args.prompt_file)
     print(f"Loaded prompt template from {args.prompt_file}")
 
+    batch_prompt_template = None
+    if args.batch_size > 1:
+        batch_prompt_template = load_prompt(args.batch_prompt_file)
+        print(f"Loaded batch prompt template from {args.batch_prompt_file}")
+
+    cache = None if args.no_cache else Cache(args.cache_dir)
+    issue_fields = args.issue_fields.split(',') if args.issue_fields else None
+
     print(f"Prioritizing with model {args.model} using Elo scoring...")
-    prioritized_issues = elo_rank_issues(issues, bedrock_client, args.model, prompt_template, args.max_comparisons)
+    async with aioboto3.Session().client('bedrock-runtime', config=bedrock_client_config(args.concurrency)) as bedrock_client:
+        prioritized_issues, comparisons = await elo_rank_issues(issues, bedrock_client, args.model, prompt_template, args.max_comparisons,
+                                                   args.concurrency, cache, args.latency_optimized, args.batch_size,
+                                                   batch_prompt_template, args.rounds, args.convergence, args.max_tokens, issue_fields,
+                                                   args.prompt_cache)
+    if cache is not None:
+        cache.close()
 
     print(f"Saving to {args.output}...")
-    save_issues(prioritized_issues, args.output)
+    save_issues(prioritized_issues, args.output, comparisons)
 
     runtime = time.time() - start_time
     print_prioritization_summary(prioritized_issues, runtime)
+    print_token_usage()
+
+def main():
+    asyncio.run(main_async())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+"""
+Hybrid Security Issue Prioritizer: Local Reranking with LLM Refinement
+This script ranks every security issue with a local cross-encoder reranker, then uses a
+large language model (LLM) via AWS Bedrock to refine the order of only the top issues
+with Elo-scored pairwise comparisons.
+
+The reranker scores each issue against a fixed "how urgent is this security issue" query
+in milliseconds on a CPU, so the bulk of the ranking costs no Bedrock calls. The LLM's
+slower, more careful reasoning is reserved for the issues that matter most.
+
+Pros:
+- Orders of magnitude fewer Bedrock calls than ranking every issue with the LLM
+- Scales to thousands of issues
+- Top issues still get pairwise LLM reasoning
+
+Cons:
+- Issues below the top-k are ordered by the reranker alone, without reasoning
+- An urgent issue the reranker places below the top-k is never refined
+- Downloads and runs a local transformer model
+
+Features:
+- Supports any sentence-transformers CrossEncoder model for the local ranking
+- Supports Claude models via AWS Bedrock (Haiku, Sonnet, Opus) for the refinement
+- Annotates each issue with its reranker score, and refined issues with Elo reasoning
+
+Usage:
+    ./hybrid_sort.py [--issues input.json] [--output prioritized.json] [--model <model_id>] [--reranker-model <model>] [--top-k-refine <k>]
+
+Options:
+    --issues         Path to input file containing unprioritized issues (default: input-issues.json)
+    --output         Output file for sorted and annotated issues (default: prioritized-issues.json)
+    --model          AWS Bedrock model ID (e.g., Claude Haiku, Sonnet, or Opus)
+    --summary-only   Show prioritization summary from existing output file without rerunning the models
+    --reranker-model sentence-transformers CrossEncoder model for the local ranking (default: BAAI/bge-reranker-v2-m3)
+    --top-k-refine   Number of top reranked issues to refine with Elo and Bedrock (default: 20, 0 = no refinement)
+    --prompt-file    Path to the prompt template file (default: elo_prompt.txt)
+    --rounds         Number of Swiss-style Elo rounds over the top issues (default: ceil(log2(k)))
+    --concurrency    Maximum number of concurrent Bedrock calls (default: 8)
+    --cache-dir      Directory for caching Bedrock comparison results (default: .bedrock_cache)
+    --no-cache       Always call Bedrock instead of reusing cached comparison results
+    --no-latency-optimized  Use standard instead of latency-optimized Bedrock inference
+    --prompt-cache   Mark the prompt template's static text as a Bedrock prompt cache checkpoint (for long custom prompts)
+    --max-tokens     Maximum number of tokens generated per comparison (default: 200)
+    --issue-fields   Comma-separated allowlist of issue fields to include in prompts (default: all fields)
+    --batch-size     Number of comparisons to pack into each Bedrock call (default: 1 = no batching)
+    --batch-prompt-file  Path to the batched comparison prompt template (default: elo_batch_prompt.txt)
+
+Output:
+    - `prioritized-issues.json`: Sorted issues with reranker scores, Elo scores and reasoning
+    - Terminal summary: Ranked list with reranker score, Elo, severity, and truncated title/message
+
+Written by: Daniel Grzelak (@dagrz on X, daniel.grzelak@plerion.com)  
+For more tools and security automation, visit: https://www.plerion.com
+"""
+
+import argparse
+import orjson
+import aioboto3
+import asyncio
+from diskcache import Cache
+from sentence_transformers import CrossEncoder
+from typing import List, Dict, Any, Tuple
+import time
+
+from bedrock_common import bedrock_client_config, load_prompt, non_negative_int, positive_int, print_token_usage, serialize_issue
+from elo_sort import elo_rank_issues, load_issues, save_issues
+
+RERANK_QUERY = "How urgent is this security issue to fix?"
+
+def parse_arguments() -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="AI-powered security issue prioritization tool using a local reranker and AWS Bedrock"
+    )
+    parser.add_argument("--issues", type=str, default="input-issues.json")
+    parser.add_argument("--output", type=str, default="prioritized-issues.json")
+    parser.add_argument("--model", type=str, default="anthropic.claude-3-haiku-20240307-v1:0")
+    parser.add_argument("--summary-only", action="store_true")
+    parser.add_argument("--reranker-model", type=str, default="BAAI/bge-reranker-v2-m3",
+                      help="sentence-transformers CrossEncoder model for the local ranking (default: BAAI/bge-reranker-v2-m3)")
+    parser.add_argument("--top-k-refine", type=non_negative_int, default=20,
+                      help="Number of top reranked issues to refine with Elo and Bedrock (default: 20, 0 = no refinement)")
+    parser.add_argument("--prompt-file", type=str, default="elo_prompt.txt",
+                      help="Path to the prompt template file (default: elo_prompt.txt)")
+    parser.add_argument("--rounds", type=int, default=None,
+                      help="Number of Swiss-style Elo rounds over the top issues (default: ceil(log2(k)))")
+    parser.add_argument("--concurrency", "--max-workers", type=positive_int, default=8,
+                      help="Maximum number of concurrent Bedrock calls (default: 8)")
+    parser.add_argument("--cache-dir", type=str, default=".bedrock_cache",
+                      help="Directory for caching Bedrock comparison results between runs (default: .bedrock_cache)")
+    parser.add_argument("--no-cache", action="store_true",
+                      help="Always call Bedrock instead of reusing cached comparison results")
+    parser.add_argument("--latency-optimized", action=argparse.BooleanOptionalAction, default=True,
+                      help="Request Bedrock latency-optimized inference, falling back to standard inference for unsupported models (default: enabled)")
+    parser.add_argument("--prompt-cache", action=argparse.BooleanOptionalAction, default=False,
+                      help="Mark the text before the prompt template's first placeholder as a Bedrock prompt cache checkpoint. Only pays off for custom templates whose static text reaches the model's minimum cacheable length (default: disabled)")
+    parser.add_argument("--max-tokens", type=positive_int, default=200,
+                      help="Maximum number of tokens the model may generate per comparison (default: 200)")
+    parser.add_argument("--issue-fields", type=str, default=None,
+                      help="Comma-separated allowlist of issue fields to include in prompts and reranker inputs, e.g. id,type,severityLevel,title,message (default: all fields)")
+    parser.add_argument("--batch-size", type=positive_int, default=1,
+                      help="Number of comparisons to pack into each Bedrock call (default: 1 = no batching)")
+    parser.add_argument("--batch-prompt-file", type=str, default="elo_batch_prompt.txt",
+                      help="Path to the prompt template file for batched comparisons (default: elo_batch_prompt.txt)")
+    return parser.parse_args()
+
+def rerank_issues(issues: List[Dict[str, Any]], reranker_model: str, issue_fields: List[str] = None) -> Tuple[List[Dict[str, Any]], List[float]]:
+    """Score every issue against RERANK_QUERY with a local cross-encoder and sort by score.
+
+    Returns the sorted issues and their scores in the same order. The issues are left
+    unannotated so the scores don't leak into refinement prompts or cache keys.
+    """
+    model = CrossEncoder(reranker_model)
+    scores = model.predict([(RERANK_QUERY, serialize_issue(issue, issue_fields)) for issue in issues], show_progress_bar=True)
+    ranked = sorted(zip(issues, scores.tolist()), key=lambda x: x[1], reverse=True)
+    return [issue for issue, _ in ranked], [score for _, score in ranked]
+
+def print_prioritization_summary(issues: List[Dict[str, Any]], runtime: float) -> None:
+    """Print the ranked summary of prioritized issues."""
+    width = 140
+    title_width = width - 55  # Reduced to make room for reranker and Elo scores
+    print("\nHybrid Issues Summary:")
+    print("=" * width)
+    print(f"{'Rank':<6} {'Rerank':<8} {'Elo':<8} {'Severity':<10} {'Type':<15} {'Title/Message':<{title_width}}")
+    print("-" * width)
+    for i, issue in enumerate(issues, 1):
+        title = issue.get('message', '') or issue.get('title', '')
+        title = (title[:title_width - 6] + "...") if len(title) > title_width - 3 else title
+        elo = f"{issue['elo']:.0f}" if 'elo' in issue else '-'
+        print(f"{i:<6} {issue['rerank_score']:<8.3f} {elo:<8} {issue.get('severityLevel', 'UNKNOWN'):<10} {issue.get('type', '').upper():<15} {title:<{title_width}}")
+    print("=" * width)
+    print(f"Total issues prioritized: {len(issues)}")
+    print(f"Total runtime: {runtime:.2f} seconds")
+
+async def main_async():
+    args = parse_arguments()
+    start_time = time.time()
+
+    if args.summary_only:
+        try:
+            with open(args.output, 'rb') as f:
+                issues = orjson.loads(f.read()).get('issues', [])
+            print_prioritization_summary(issues, time.time() - start_time)
+            return
+        except Exception as e:
+            print(f"Error reading summary: {e}")
+            return
+
+    issues = load_issues(args.issues)
+    print(f"Loaded {len(issues)} issues")
+
+    issue_fields = args.issue_fields.split(',') if args.issue_fields else None
+
+    print(f"Ranking issues locally with reranker {args.reranker_model}...")
+    ranked, rerank_scores = rerank_issues(issues, args.reranker_model, issue_fields)
+    top, rest = ranked[:args.top_k_refine], ranked[args.top_k_refine:]
+    comparisons = []
+
+    if len(top) > 1:
+        prompt_template = load_prompt(args.prompt_file)
+        print(f"Loaded prompt template from {args.prompt_file}")
+
+        batch_prompt_template = None
+        if args.batch_size > 1:
+            batch_prompt_template = load_prompt(args.batch_prompt_file)
+            print(f"Loaded batch prompt template from {args.batch_prompt_file}")
+
+        cache = None if args.no_cache else Cache(args.cache_dir)
+
+        print(f"Refining the top {len(top)} issues with model {args.model} using Elo scoring...")
+        async with aioboto3.Session().client('bedrock-runtime', config=bedrock_client_config(args.concurrency)) as bedrock_client:
+            top, comparisons = await elo_rank_issues(top, bedrock_client, args.model, prompt_template, 1.0, args.concurrency,
+                                                     cache, args.latency_optimized, args.batch_size, batch_prompt_template,
+                                                     args.rounds, max_tokens=args.max_tokens, issue_fields=issue_fields,
+                                                     prompt_cache=args.prompt_cache)
+        if cache is not None:
+            cache.close()
+
+    # Annotate only after refinement, so Elo prompts and cache keys never see the scores
+    for issue, score in zip(ranked, rerank_scores):
+        issue['rerank_score'] = score
+    prioritized_issues = top + rest
+
+    print(f"Saving to {args.output}...")
+    save_issues(prioritized_issues, args.output, comparisons)
+
+    runtime = time.time() - start_time
+    print_prioritization_summary(prioritized_issues, runtime)
+    print_token_usage()
+
+def main():
+    asyncio.run(main_async())
+
+if __name__ == "__main__":
+    main()
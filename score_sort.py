@@ -32,6 +32,13 @@ Options:
     --model          AWS Bedrock model ID (e.g., Claude Haiku, Sonnet, or Opus)
     --summary-only   Show prioritization summary from existing output file without rerunning the model
     --prompt-file    Path to the prompt template file (default: score_prompt.txt)
+    --cache-dir      Directory for caching Bedrock scoring results (default: .bedrock_cache)
+    --no-cache       Always call Bedrock instead of reusing cached scoring results
+    --concurrency    Maximum number of concurrent Bedrock calls (default: 8)
+    --no-latency-optimized  Use standard instead of latency-optimized Bedrock inference
+    --prompt-cache   Mark the prompt template's static text as a Bedrock prompt cache checkpoint (for long custom prompts)
+    --max-tokens     Maximum number of tokens generated per score (default: 300)
+    --issue-fields   Comma-separated allowlist of issue fields to include in prompts (default: all fields)
 
 Output:
     - `prioritized-issues.json`: Sorted issues with scoring metadata and reasoning
@@ -42,13 +49,17 @@ For more tools and security automation, visit: https://www.plerion.com
 """
 
 import argparse
-import json
-import boto3
+import orjson
+import aioboto3
+import asyncio
+from diskcache import Cache
 from typing import List, Dict, Any
+import numpy as np
 from tqdm import tqdm
-import re
 import time
 
+from bedrock_common import SCORING_TOOL, bedrock_client_config, cache_key, converse, load_prompt, positive_int, print_token_usage, serialize_issue, static_prefix
+
 def parse_arguments() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="LLM scoring for security issues")
     parser.add_argument("--issues", type=str, default="input-issues.json")
@@ -57,49 +68,65 @@ def parse_arguments() -> argparse.Namespace:
     parser.add_argument("--summary-only", action="store_true")
     parser.add_argument("--prompt-file", type=str, default="score_prompt.txt",
                       help="Path to the prompt template file (default: score_prompt.txt)")
+    parser.add_argument("--cache-dir", type=str, default=".bedrock_cache",
+                      help="Directory for caching Bedrock scoring results between runs (default: .bedrock_cache)")
+    parser.add_argument("--no-cache", action="store_true",
+                      help="Always call Bedrock instead of reusing cached scoring results")
+    parser.add_argument("--concurrency", "--max-workers", type=positive_int, default=8,
+                      help="Maximum number of concurrent Bedrock calls (default: 8)")
+    parser.add_argument("--max-tokens", type=positive_int, default=300,
+                      help="Maximum number of tokens the model may generate per score (default: 300)")
+    parser.add_argument("--issue-fields", type=str, default=None,
+                      help="Comma-separated allowlist of issue fields to include in prompts, e.g. id,type,severityLevel,title,message (default: all fields)")
+    parser.add_argument("--latency-optimized", action=argparse.BooleanOptionalAction, default=True,
+                      help="Request Bedrock latency-optimized inference, falling back to standard inference for unsupported models (default: enabled)")
+    parser.add_argument("--prompt-cache", action=argparse.BooleanOptionalAction, default=False,
+                      help="Mark the text before the prompt template's first placeholder as a Bedrock prompt cache checkpoint. Only pays off for custom templates whose static text reaches the model's minimum cacheable length (default: disabled)")
     return parser.parse_args()
 
 def load_issues(file_path: str) -> List[Dict[str, Any]]:
-    with open(file_path, 'r') as f:
-        return json.load(f).get('issues', [])
+    with open(file_path, 'rb') as f:
+        return orjson.loads(f.read()).get('issues', [])
 
 def save_issues(issues: List[Dict[str, Any]], file_path: str) -> None:
-    with open(file_path, 'w') as f:
-        json.dump({'issues': issues}, f, indent=2)
-
-def sanitize_json_string(s: str) -> str:
-    s = re.sub(r'[\x00-\x1F\x7F-\x9F]', '', s)
-    return ''.join(c for c in s if c.isprintable() or c.isspace())
-
-def load_prompt(file_path: str) -> str:
-    """Load prompt template from file."""
-    with open(file_path, 'r') as f:
-        return f.read()
-
-def create_scoring_prompt(issue: Dict[str, Any], prompt_template: str) -> str:
-    return prompt_template.format(issue=json.dumps(issue, indent=2))
-
-def score_issue(issue: Dict[str, Any], bedrock_client, model_id: str, prompt_template: str) -> Dict[str, Any]:
-    prompt = create_scoring_prompt(issue, prompt_template)
+    with open(file_path, 'wb') as f:
+        f.write(orjson.dumps({'issues': issues}, option=orjson.OPT_INDENT_2))
+
+def create_scoring_prompt(issue_json: str, prompt_template: str) -> str:
+    return prompt_template.format(issue=issue_json)
+
+async def score_issue(issue: Dict[str, Any], bedrock_client, model_id: str, prompt_template: str, cache: Cache = None, latency_optimized: bool = True, max_tokens: int = 300, issue_fields: List[str] = None, prompt_cache: bool = False) -> Dict[str, Any]:
+    issue_json = serialize_issue(issue, issue_fields)
+    key = cache_key(model_id, prompt_template, issue_json)
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            issue['score'], issue['reasoning'] = cached
+            return issue
+    prompt = create_scoring_prompt(issue_json, prompt_template)
     try:
-        response = bedrock_client.invoke_model(
-            modelId=model_id,
-            body=json.dumps({
-                "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": 1000,
-                "messages": [{"role": "user", "content": prompt}]
-            })
-        )
-        response_text = json.loads(response['body'].read())['content'][0]['text']
-        result = json.loads(sanitize_json_string(response_text))
+        result = await converse(bedrock_client, model_id, prompt, latency_optimized, max_tokens,
+                                prompt_prefix=static_prefix(prompt_template) if prompt_cache else '', tool=SCORING_TOOL)
         issue['score'] = result['score']
         issue['reasoning'] = result['reasoning']
+        if cache is not None:
+            cache.set(key, (issue['score'], issue['reasoning']))
     except Exception as e:
         print(f"Error scoring issue: {e}")
         issue['score'] = 50
         issue['reasoning'] = f"Fallback score due to error: {e}"
     return issue
 
+# Above this many issues a NumPy argsort beats sorting with a Python key function
+NUMPY_SORT_THRESHOLD = 1000
+
+def sort_by_score(issues: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Sort issues by descending score, keeping the input order of equal scores."""
+    if len(issues) <= NUMPY_SORT_THRESHOLD:
+        return sorted(issues, key=lambda x: x['score'], reverse=True)
+    scores = np.fromiter((x['score'] for x in issues), dtype=np.float32, count=len(issues))
+    return [issues[k] for k in np.argsort(-scores, kind='stable')]
+
 def print_summary(issues: List[Dict[str, Any]], runtime: float) -> None:
     width = 140
     title_width = width - 45  # Reduced to make room for severity
@@ -115,40 +142,55 @@ def print_summary(issues: List[Dict[str, Any]], runtime: float) -> None:
     print(f"Total issues scored: {len(issues)}")
     print(f"Total runtime: {runtime:.2f} seconds")
 
-def main():
+async def main_async():
     args = parse_arguments()
     start_time = time.time()
 
     if args.summary_only:
         try:
-            with open(args.output, 'r') as f:
-                issues = json.load(f).get('issues', [])
-            print_summary(sorted(issues, key=lambda x: x['score'], reverse=True), time.time() - start_time)
+            with open(args.output, 'rb') as f:
+                issues = orjson.loads(f.read()).get('issues', [])
+            print_summary(sort_by_score(issues), time.time() - start_time)
             return
         except Exception as e:
             print(f"Error reading summary: {e}")
             return
 
-    bedrock_client = boto3.client('bedrock-runtime')
-
     issues = load_issues(args.issues)
     print(f"Loaded {len(issues)} issues")
 
     prompt_template = load_prompt(args.prompt_file)
     print(f"Loaded prompt template from {args.prompt_file}")
 
-    print(f"Scoring issues using model {args.model}...")
-    scored = []
-    for issue in tqdm(issues, desc="Scoring issues"):
-        scored.append(score_issue(issue, bedrock_client, args.model, prompt_template))
+    cache = None if args.no_cache else Cache(args.cache_dir)
+    issue_fields = args.issue_fields.split(',') if args.issue_fields else None
 
-    scored.sort(key=lambda x: x['score'], reverse=True)
+    print(f"Scoring issues using model {args.model}...")
+    # Issues are scored independently, so score them concurrently (gather keeps input order)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    async with aioboto3.Session().client('bedrock-runtime', config=bedrock_client_config(args.concurrency)) as bedrock_client:
+        with tqdm(total=len(issues), desc="Scoring issues") as pbar:
+            async def score(issue: Dict[str, Any]) -> Dict[str, Any]:
+                async with semaphore:
+                    scored_issue = await score_issue(issue, bedrock_client, args.model, prompt_template, cache, args.latency_optimized,
+                                                     args.max_tokens, issue_fields, args.prompt_cache)
+                pbar.update(1)
+                return scored_issue
+            scored = await asyncio.gather(*(score(issue) for issue in issues))
+    if cache is not None:
+        cache.close()
+
+    scored = sort_by_score(scored)
 
     print(f"Saving to {args.output}...")
     save_issues(scored, args.output)
 
     runtime = time.time() - start_time
     print_summary(scored, runtime)
+    print_token_usage()
+
+def main():
+    asyncio.run(main_async())
 
 if __name__ == "__main__":
     main()